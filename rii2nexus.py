@@ -1,11 +1,14 @@
 """Convert the refractiveindex.info database to nexus"""
-from collections import namedtuple
-from functools import lru_cache, partial
+import argparse
+from collections import Counter
+from functools import lru_cache
+from multiprocessing import Pool
 import os
 from pathlib import Path
 import logging
+import pickle
 import re
-from typing import List
+from typing import Any, FrozenSet, Mapping, Optional, Tuple
 import pandas as pd
 import yaml
 from ase.data import chemical_symbols
@@ -13,33 +16,100 @@ from tqdm import tqdm
 
 from nexusutils.dataconverter.convert import convert, logger
 
-logger.setLevel(logging.ERROR)
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
 
+logger.setLevel(logging.ERROR)
 
-def load_rii_database():
-    """Loads the rii database"""
-    Entry = namedtuple(
-        "Entry",
-        [
-            "category",
-            "category_description",
-            "material_category",
-            "material",
-            "material_description",
-            "reference",
-            "reference_category",
-            "reference_description",
-            "path",
-        ],
+_TAG_RE = re.compile(r"\<[^\>]*\>")
+_POLYMER_RE = re.compile(r"\(([^\)]+)\)n")
+_MAT_DESCR_RE = re.compile(r"^(.*)\(([^\(\)]+)\)$")
+_NON_ALNUM_RE = re.compile(r"[^A-Za-z0-9]")
+# Match longer element names first (i.e. Si before S)
+_ELEMENT_NAMES = sorted(
+    (set(chemical_symbols) - {"X"}) | {"D", "T"}, key=lambda name: (-len(name), name)
+)
+_ELEMENT_RE = re.compile(rf"({'|'.join(_ELEMENT_NAMES)})(\d*)")
+_SECONDARY_AXIS_PATTERN = r"-(?:e|beta|gamma)\."
+_MADE_DIRS = set()
+_WORKER_CATALOG_PATHS: FrozenSet[str] = frozenset()
+# Bump when the catalog columns produced by load_rii_database change
+_CATALOG_CACHE_VERSION = 1
+_CATALOG_CACHE_PATH = Path("rii_catalog.pkl")
+
+
+def read_catalog_cache(yml_path: Path) -> Optional[pd.DataFrame]:
+    """Reads the cached catalog if it is valid for the yml file"""
+    if (
+        not _CATALOG_CACHE_PATH.exists()
+        or _CATALOG_CACHE_PATH.stat().st_mtime < yml_path.stat().st_mtime
+    ):
+        return None
+
+    try:
+        with _CATALOG_CACHE_PATH.open("rb") as cache:
+            cached = pickle.load(cache)
+    except Exception:  # pylint: disable=broad-except
+        logging.info("Ignoring unreadable catalog cache %s", _CATALOG_CACHE_PATH)
+        return None
+
+    version = cached.get("version") if isinstance(cached, dict) else None
+    if version != (_CATALOG_CACHE_VERSION, pd.__version__):
+        return None
+
+    return cached["catalog"]
+
+
+def write_catalog_cache(catalog: pd.DataFrame):
+    """Atomically writes the catalog cache, skipping it on any failure"""
+    tmp_path = _CATALOG_CACHE_PATH.with_name(
+        f"{_CATALOG_CACHE_PATH.name}.{os.getpid()}.tmp"
     )
+    try:
+        with tmp_path.open("wb") as cache:
+            pickle.dump(
+                {
+                    "version": (_CATALOG_CACHE_VERSION, pd.__version__),
+                    "catalog": catalog,
+                },
+                cache,
+            )
+        os.replace(tmp_path, _CATALOG_CACHE_PATH)
+    except (OSError, pickle.PicklingError, TypeError) as err:
+        logging.info("Not writing catalog cache %s: %s", _CATALOG_CACHE_PATH, err)
+    finally:
+        tmp_path.unlink(missing_ok=True)
 
-    rii_path = Path("refractiveindex.info-database/database")
 
-    yml_file = yaml.load(
-        rii_path.joinpath("library.yml").read_text(encoding="utf-8"), yaml.SafeLoader
-    )
+def load_rii_database():
+    """Loads the rii database
 
-    entries = []
+    The parsed catalog is cached in rii_catalog.pkl and reused as long as
+    the cache is not older than library.yml and matches the cache version.
+    """
+    rii_path = Path("refractiveindex.info-database/database")
+    yml_path = rii_path.joinpath("library.yml")
+
+    catalog = read_catalog_cache(yml_path)
+    if catalog is not None:
+        return catalog
+
+    with yml_path.open("rb") as yml:
+        yml_file = yaml.load(yml, SafeLoader)
+
+    columns = {
+        "category": [],
+        "category_description": [],
+        "material_category": [],
+        "material": [],
+        "material_description": [],
+        "reference": [],
+        "reference_category": [],
+        "reference_description": [],
+        "path": [],
+    }
     for category in yml_file:
         material_div = None
         for material in category["content"]:
@@ -53,28 +123,32 @@ def load_rii_database():
                     ref_div = ref["DIVIDER"]
                     continue
 
-                entries.append(
-                    Entry(
-                        category["SHELF"],
-                        category["name"],
-                        material_div,
-                        material["BOOK"],
-                        material["name"],
-                        ref["PAGE"],
-                        ref_div,
-                        ref["name"],
-                        os.path.join("data", os.path.normpath(ref["data"])),
-                    )
+                columns["category"].append(category["SHELF"])
+                columns["category_description"].append(category["name"])
+                columns["material_category"].append(material_div)
+                columns["material"].append(material["BOOK"])
+                columns["material_description"].append(material["name"])
+                columns["reference"].append(ref["PAGE"])
+                columns["reference_category"].append(ref_div)
+                columns["reference_description"].append(ref["name"])
+                columns["path"].append(
+                    os.path.join("data", os.path.normpath(ref["data"]))
                 )
 
-    return pd.DataFrame(entries, dtype=pd.StringDtype())
+    catalog = pd.DataFrame(columns, dtype=pd.StringDtype())
+    write_catalog_cache(catalog)
+
+    return catalog
 
 
 def yml_path2nexus_path(path: str) -> str:
     """Converts the yml path to a nexus path"""
-    path, fname = path.replace("data/", "dispersions/").rsplit("/", 1)
-    os.makedirs(path, exist_ok=True)
-    return Path(path) / f"{fname.rsplit('.', 1)[0]}.nxs"
+    path, _, fname = path.replace("data/", "dispersions/").rpartition("/")
+    if path not in _MADE_DIRS:
+        os.makedirs(path, exist_ok=True)
+        _MADE_DIRS.add(path)
+    stem = fname.rpartition(".")[0] or fname
+    return f"{path}/{stem}.nxs"
 
 
 def prefix_path(path: str) -> str:
@@ -82,7 +156,7 @@ def prefix_path(path: str) -> str:
     return f"refractiveindex.info-database/database/{path}"
 
 
-def parse_mat_desc(material_description: str):
+def parse_mat_desc(material_description: str) -> Tuple[str, Tuple[str, ...]]:
     """Parse the material description into a formula and colloquial names"""
 
     def get_colloq_names():
@@ -91,19 +165,19 @@ def parse_mat_desc(material_description: str):
             colloq_names.append(f"({formula})n")
         if colloquial_names:
             colloq_names.append(colloquial_names)
-        return colloq_names
+        return tuple(colloq_names)
 
     def clean_formula():
-        return re.sub(r"[^A-Za-z0-9]", "", formula)
+        return _NON_ALNUM_RE.sub("", formula)
 
-    material_description = re.sub(r"\<[^\>]*\>", "", material_description)
-    polymer = re.match(r"\(([^\)]+)\)n", material_description)
+    material_description = _TAG_RE.sub("", material_description)
+    polymer = _POLYMER_RE.match(material_description)
     if polymer:
         formula = polymer.group(1)
         colloquial_names = material_description.rsplit(")n", 1)[-1].strip("() ")
         return clean_formula(), get_colloq_names()
 
-    mat_descr = re.match(r"^(.*)\(([^\(\)]+)\)$", material_description)
+    mat_descr = _MAT_DESCR_RE.match(material_description)
     formula, colloquial_names = (
         mat_descr.groups() if mat_descr else (material_description, "")
     )
@@ -111,55 +185,45 @@ def parse_mat_desc(material_description: str):
     return clean_formula(), get_colloq_names()
 
 
-@lru_cache(maxsize=None)
-def element_regex():
-    """Compiles a regex to find element symbols"""
-    element_names = chemical_symbols.copy()  # Don't mess with the ase internal list
-    element_names.remove("X")
-    element_names += ["D", "T"]
-    # Sort and reverse to ensure matching longer element names first (i.e. Si before S)
-    element_names.sort()
-    element_names.reverse()
-
-    return re.compile(rf"({'|'.join(element_names)})(\d*)")
-
-
 def hill_sorted_elements(elements):
     """Get a Hill sorted list of (element, amount) tuples from an input list"""
-    elems_dict = {}
+    counts = Counter()
     for elem, amount in elements:
-        elems_dict[elem] = elems_dict.get(elem, 0) + (int(amount) if amount else 1)
-
-    elems = []
-    if "C" in elems_dict:
-        c_amount = elems_dict.pop("C")
-        h_amount = elems_dict.pop("H", 0)
-        elems += [("C", c_amount)]
-        if h_amount:
-            elems += [("H", h_amount)]
-    elems += sorted(elems_dict.items())
+        counts[elem] += int(amount) if amount else 1
 
-    return elems
+    # Carbon first, then hydrogen if there is carbon, then all others alphabetically
+    hill_order = {"C": 0, "H": 1} if "C" in counts else {}
+    return sorted(
+        counts.items(), key=lambda elem: (hill_order.get(elem[0], 2), elem[0])
+    )
 
 
-def fill_material(metadata: dict, entry: pd.DataFrame):
-    """Fill the data dict for a material from the entry"""
-    clean_chemical_formula, colloquial_names = parse_mat_desc(
-        entry["material_description"]
-    )
+@lru_cache(maxsize=None)
+def material_metadata(material_description: str) -> Tuple[Tuple[str, str], ...]:
+    """Get the sample metadata items derived from a material description"""
+    metadata = {}
+    clean_chemical_formula, colloquial_names = parse_mat_desc(material_description)
     metadata["/ENTRY[entry]/sample/chemical_formula"] = clean_chemical_formula
     if colloquial_names:
         metadata["/ENTRY[entry]/sample/colloquial_name"] = ", ".join(colloquial_names)
 
-    elements = element_regex().findall(clean_chemical_formula)
+    elements = _ELEMENT_RE.findall(clean_chemical_formula)
     if elements:
         elems = hill_sorted_elements(elements)
-        metadata["/ENTRY[entry]/sample/atom_types"] = ",".join(list(zip(*elems))[0])
+        metadata["/ENTRY[entry]/sample/atom_types"] = ",".join(
+            elem for elem, _ in elems
+        )
+
+        metadata["/ENTRY[entry]/sample/chemical_formula"] = "".join(
+            f"{elem}{amount}" if amount > 1 else elem for elem, amount in elems
+        )
+
+    return tuple(metadata.items())
 
-        chemical_formula = ""
-        for elem, amount in elems:
-            chemical_formula += f"{elem}{amount}" if amount > 1 else f"{elem}"
-        metadata["/ENTRY[entry]/sample/chemical_formula"] = chemical_formula
+
+def fill_material(metadata: dict, entry: Mapping[str, Any]):
+    """Fill the data dict for a material from the entry"""
+    metadata.update(material_metadata(entry["material_description"]))
 
     if pd.isnull(entry["reference_category"]):
         return
@@ -185,7 +249,7 @@ def fill_glass(metadata, entry):
     metadata["/ENTRY[entry]/sample/material_phase_comment"] = "glass, amorphous"
 
 
-def fill(metadata: dict, entry: pd.DataFrame):
+def fill(metadata: dict, entry: Mapping[str, Any]):
     """Fill the datadict from an entry"""
     if entry["category"] == "glass":
         return fill_glass(metadata, entry)
@@ -206,72 +270,90 @@ def write_nexus(path: str, metadata: dict):
     )
 
 
-def create_nexus(entry, catalog):
-    """Create a nexus file from a rii entry"""
+def create_nexus(entry: dict, catalog_paths: FrozenSet[str]):
+    """Create a nexus file from a rii entry
 
-    def skip_entries(skip_on: List[str]) -> bool:
-        for skip in skip_on:
-            if f"-{skip}." in entry["path"]:
-                logging.info("Skipping entry: %s", entry["path"])
-                return True
-        return False
+    The entry has to carry the axis_kind column, which is added by
+    create_nexus_database. Entries of secondary axes must be filtered
+    out beforehand, as they are written together with their primary axis.
+    """
 
-    def get_secondary_entry(base: str, secondary: str) -> pd.DataFrame:
+    def get_secondary_entry(base: str, secondary: str) -> str:
         path = entry["path"].replace(f"-{base}.", f"-{secondary}.")
-        sec_entry = catalog[catalog["path"] == path]
-        assert len(sec_entry) == 1
+        assert path in catalog_paths
         return path
 
-    def fill_uniaxial_entry() -> bool:
-        if "-o." in entry["path"]:
-            metadata = {}
-            logging.info("Searching for e axis for %s", entry["reference"])
-            e_path = get_secondary_entry("o", "e")
+    def fill_uniaxial_entry():
+        logging.info("Searching for e axis for %s", entry["reference"])
+        e_path = get_secondary_entry("o", "e")
 
-            metadata = {}
-            metadata["dispersion_z"] = prefix_path(e_path)
-            fill(metadata, entry)
-            write_nexus(entry["path"], metadata)
-
-            return True
-        return False
-
-    def fill_biaxial_entry() -> bool:
-        if "-alpha." in entry["path"]:
-            logging.info("Searching for beta and gamma axis for %s", entry["reference"])
-            beta_path = get_secondary_entry("alpha", "beta")
-            gamma_path = get_secondary_entry("alpha", "gamma")
+        metadata = {}
+        metadata["dispersion_z"] = prefix_path(e_path)
+        fill(metadata, entry)
+        write_nexus(entry["path"], metadata)
 
-            metadata = {}
-            metadata["dispersion_y"] = prefix_path(beta_path)
-            metadata["dispersion_z"] = prefix_path(gamma_path)
-            fill(metadata, entry)
-            write_nexus(entry["path"], metadata)
+    def fill_biaxial_entry():
+        logging.info("Searching for beta and gamma axis for %s", entry["reference"])
+        beta_path = get_secondary_entry("alpha", "beta")
+        gamma_path = get_secondary_entry("alpha", "gamma")
 
-            return True
-        return False
+        metadata = {}
+        metadata["dispersion_y"] = prefix_path(beta_path)
+        metadata["dispersion_z"] = prefix_path(gamma_path)
+        fill(metadata, entry)
+        write_nexus(entry["path"], metadata)
 
     def fill_entry():
         metadata = {}
         fill(metadata, entry)
         write_nexus(entry["path"], metadata)
 
-    if skip_entries(["e", "beta", "gamma"]):
-        return
+    handlers = {"o": fill_uniaxial_entry, "alpha": fill_biaxial_entry}
+    handlers.get(entry["axis_kind"], fill_entry)()
 
-    if fill_uniaxial_entry():
-        return
 
-    if fill_biaxial_entry():
-        return
+def init_worker(catalog_paths: FrozenSet[str]):
+    """Installs the catalog paths once per pool worker"""
+    global _WORKER_CATALOG_PATHS  # pylint: disable=global-statement
+    _WORKER_CATALOG_PATHS = catalog_paths
+
+
+def create_nexus_worker(entry: dict):
+    """Create a nexus file from a rii entry inside a pool worker"""
+    create_nexus(entry, _WORKER_CATALOG_PATHS)
+
+
+def create_nexus_database(catalog: pd.DataFrame, processes: int = 1):
+    """Creates the nexus database from the rii database
 
-    fill_entry()
+    convert() downloads missing bibtex entries and stores them in the shared
+    rii_bibtex.sqlite cache, so entries are processed serially by default.
+    Passing processes > 1 converts entries in a process pool instead.
+    """
+    catalog_paths = frozenset(catalog["path"])
+    paths = catalog["path"]
+    # Uniaxial entries take precedence over biaxial ones
+    catalog = catalog.assign(
+        axis_kind=pd.Series("plain", index=catalog.index)
+        .mask(paths.str.contains("-alpha.", regex=False), "alpha")
+        .mask(paths.str.contains("-o.", regex=False), "o")
+    )
+    # Secondary axes are written together with their o or alpha entry,
+    # so any path containing one of their markers is skipped first
+    skipped = paths.str.contains(_SECONDARY_AXIS_PATTERN)
+    logging.info("Skipping %d secondary axis entries", skipped.sum())
+
+    records = catalog[~skipped].to_dict("records")
 
+    if processes == 1:
+        for entry in tqdm(records):
+            create_nexus(entry, catalog_paths)
+        return
 
-def create_nexus_database(catalog: pd.DataFrame):
-    """Creates the nexus database from the rii database"""
-    tqdm.pandas()
-    catalog.progress_apply(partial(create_nexus, catalog=catalog), axis=1)
+    with Pool(processes, initializer=init_worker, initargs=(catalog_paths,)) as pool:
+        results = pool.imap_unordered(create_nexus_worker, records, chunksize=32)
+        for _ in tqdm(results, total=len(records)):
+            pass
 
 
 def extract_metadata(catalog: pd.DataFrame, samples=5):
@@ -290,7 +372,19 @@ def extract_metadata(catalog: pd.DataFrame, samples=5):
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=1,
+        help=(
+            "Number of worker processes. Values above 1 download bibtex entries "
+            "into the shared rii_bibtex.sqlite cache concurrently."
+        ),
+    )
+    args = parser.parse_args()
+
     database = load_rii_database()
 
-    create_nexus_database(database)
+    create_nexus_database(database, processes=args.processes)
     # extract_metadata(database)